@@ -37,6 +37,8 @@ BACKUP_INTERVAL_HOURS = int(os.getenv('BACKUP_INTERVAL_HOURS', '24'))
 
 # Webhook настройки
 WEBHOOK_URL = os.getenv('WEBHOOK_URL', 'https://axidiphoto.ru/webhook')
+REPLICATE_WEBHOOK_URL = os.getenv('REPLICATE_WEBHOOK_URL', '')
+REPLICATE_WEBHOOK_SECRET = os.getenv('REPLICATE_WEBHOOK_SECRET', '')
 
 # Ограничение на количество одновременных задач
 MAX_CONCURRENT_TASKS = 200
@@ -62,7 +62,9 @@ from handlers.broadcast import broadcast_router
 from bot_counter import bot_counter_router
 from generation.videos import video_router
 from generation.training import training_router
+from handlers import photo_transform as photo_transform_handlers
 from handlers.photo_transform import photo_transform_router, init_photo_generator
+from generation.photo_transform import PhotoTransformGenerator, close_http_client, verify_replicate_webhook
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -678,6 +680,27 @@ def webhook():
             )
         return jsonify({'status': 'error', 'message': 'Internal server error'}), 500
 
+@app.route('/replicate-webhook', methods=['POST'])
+def replicate_webhook():
+    """Обрабатывает вебхуки Replicate о завершении prediction."""
+    raw_body = request.get_data()
+    if not verify_replicate_webhook(request.headers, raw_body):
+        logger.warning("Неверная подпись webhook Replicate")
+        return jsonify({'status': 'error', 'message': 'Invalid signature'}), 401
+    try:
+        data = json.loads(raw_body)
+    except json.JSONDecodeError:
+        data = None
+    if not isinstance(data, dict) or not data.get('id'):
+        logger.error("Некорректный webhook Replicate")
+        return jsonify({'status': 'error', 'message': 'Invalid payload'}), 400
+    if not bot_event_loop:
+        logger.error("Event loop не инициализирован для webhook Replicate")
+        return jsonify({'status': 'error', 'message': 'Event loop not ready'}), 503
+    logger.info(f"Webhook Replicate: prediction={data['id']}, status={data.get('status')}")
+    bot_event_loop.call_soon_threadsafe(PhotoTransformGenerator.resolve_webhook, data)
+    return jsonify({'status': 'ok'}), 200
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Проверяет состояние бота."""
@@ -1063,6 +1086,14 @@ async def main():
             logger.info("Счетчик пользователей не имеет метода stop, пропускаем")
             await bot_instance.session.close()
             logger.info("Сессия бота закрыта")
+        # Экземпляр из init_photo_generator: останавливает фоновый опрос prediction и закрывает HTTP-клиент
+        photo_generator = photo_transform_handlers.photo_generator
+        if photo_generator is not None:
+            await photo_generator.close()
+            logger.info("Генератор Фото Преображение остановлен")
+        else:
+            await close_http_client()
+            logger.info("HTTP-клиент Replicate закрыт")
         logger.info("Бот полностью остановлен.")
 
 if __name__ == '__main__':
@@ -18,24 +18,221 @@ PixelPie AI - Фото Преображение
 
 import replicate
 import asyncio
-import aiohttp
+import base64
+import binascii
+import hashlib
+import hmac
+import importlib.util
+import httpx
+import aiofiles
+import orjson
 import os
+import re
 import logging
-from typing import Optional, Dict, Any, Union, List
+import time
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Union, List, Tuple, Mapping, IO, AsyncIterable, AsyncIterator
 from datetime import datetime
-from PIL import Image
+from types import SimpleNamespace, MappingProxyType
+from PIL import Image, ImageOps
 import io
-import magic  # Для проверки mime-типа файла
+from replicate.exceptions import ReplicateError
+from config import REPLICATE_WEBHOOK_URL, REPLICATE_WEBHOOK_SECRET, MAX_CONCURRENT_GENERATIONS
 
 logger = logging.getLogger(__name__)
 
-async def upload_image_to_replicate(image_bytes: bytes, filename: str) -> str:
+# Сигнатуры поддерживаемых форматов изображений (JPEG, PNG, GIF)
+JPEG_SIGNATURE = b'\xff\xd8\xff'
+IMAGE_SIGNATURES = (JPEG_SIGNATURE, b'\x89PNG\r\n\x1a\n', b'GIF87a', b'GIF89a')
+
+# Максимальная сторона фото перед загрузкой (gen4-image все равно работает с <=1024)
+MAX_UPLOAD_DIM = 2048
+
+# JPEG меньше этого размера (и не больше MAX_UPLOAD_DIM) загружается без перекодирования
+JPEG_PASSTHROUGH_MAX_BYTES = 8 * 1024 * 1024
+
+# Размер чанка при потоковой загрузке файла на Replicate
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Формат id файла в metadata URL (/v1/files/{id})
+FILE_ID_RE = re.compile(r'^[a-zA-Z0-9]{20,}$')
+
+# Кэш file_id по metadata URL: максимум записей
+FILE_ID_CACHE_SIZE = 32
+
+# Сколько URL, загруженных через preprocess_and_upload, помнить для пропуска повторной нормализации
+PREPROCESSED_URLS_SIZE = 256
+
+# Терминальные статусы prediction
+TERMINAL_STATUSES = ("succeeded", "failed", "canceled")
+
+# Параметры экспоненциального опроса статуса prediction
+POLL_INITIAL_DELAY = 0.5
+POLL_BACKOFF_FACTOR = 1.5
+POLL_MAX_DELAY = 5.0
+
+# Максимальный сон фоновой задачи пакетного опроса; не больше POLL_INITIAL_DELAY,
+# чтобы новый prediction был опрошен вовремя
+BATCH_POLL_INTERVAL = POLL_INITIAL_DELAY
+
+# AIMD-ограничение одновременных генераций: старт, потолок и число успехов подряд для +1
+AIMD_INITIAL_LIMIT = MAX_CONCURRENT_GENERATIONS
+AIMD_MAX_LIMIT = 32
+AIMD_INCREASE_AFTER = 5
+
+# Webhook используется только вместе с секретом для проверки подписи
+WEBHOOK_ENABLED = bool(REPLICATE_WEBHOOK_URL and REPLICATE_WEBHOOK_SECRET)
+
+# Редкий страховочный опрос, пока ожидается webhook (на случай потерянной доставки)
+WEBHOOK_POLL_INTERVAL = 30.0
+
+# Допустимое расхождение webhook-timestamp с текущим временем, секунды
+WEBHOOK_TIMESTAMP_TOLERANCE = 300
+
+# Webhook, пришедшие раньше начала ожидания: максимум записей и время жизни в секундах
+EARLY_WEBHOOK_CACHE_SIZE = 64
+EARLY_WEBHOOK_TTL = 60
+
+# HTTP/2 требует пакет h2 (httpx[http2]); без него клиенты работают по HTTP/1.1
+HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
+
+# Общий HTTP/2-клиент процесса: одно TLS-соединение к api.replicate.com, много параллельных потоков
+_HTTP_CLIENT: Optional[httpx.AsyncClient] = None
+
+def _get_http_client() -> httpx.AsyncClient:
+    """Получение общего HTTP-клиента (HTTP/2, если доступен h2) с ограничением соединений к Replicate"""
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is None or _HTTP_CLIENT.is_closed:
+        _HTTP_CLIENT = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=64,
+                max_keepalive_connections=32,
+                keepalive_expiry=75
+            ),
+            timeout=httpx.Timeout(60.0)
+        )
+    return _HTTP_CLIENT
+
+async def close_http_client() -> None:
+    """Закрытие общего HTTP-клиента при остановке бота"""
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is not None and not _HTTP_CLIENT.is_closed:
+        await _HTTP_CLIENT.aclose()
+    _HTTP_CLIENT = None
+
+def verify_replicate_webhook(headers: Mapping[str, str], body: bytes) -> bool:
     """
-    Асинхронная загрузка изображения на Replicate и получение metadata URL
+    Проверка подписи webhook Replicate (заголовки webhook-id, webhook-timestamp, webhook-signature)
     
     Args:
-        image_bytes: Байты изображения
+        headers: Заголовки запроса
+        body: Сырое тело запроса
+        
+    Returns:
+        True, если подпись корректна и timestamp свежий
+    """
+    webhook_id = headers.get('webhook-id')
+    timestamp = headers.get('webhook-timestamp')
+    signatures = headers.get('webhook-signature')
+    if not (REPLICATE_WEBHOOK_SECRET and webhook_id and timestamp and signatures):
+        return False
+    
+    try:
+        if abs(time.time() - int(timestamp)) > WEBHOOK_TIMESTAMP_TOLERANCE:
+            logger.warning(f"Webhook Replicate с устаревшим timestamp: {timestamp}")
+            return False
+        key = base64.b64decode(REPLICATE_WEBHOOK_SECRET.removeprefix('whsec_'))
+    except (ValueError, binascii.Error) as e:
+        logger.error(f"Некорректный timestamp или секрет webhook Replicate: {e}")
+        return False
+    
+    signed_content = f"{webhook_id}.{timestamp}.".encode() + body
+    expected = base64.b64encode(hmac.new(key, signed_content, hashlib.sha256).digest()).decode()
+    # Заголовок содержит список подписей через пробел в формате "v1,<base64>"
+    return any(
+        hmac.compare_digest(expected, signature.split(',', 1)[-1])
+        for signature in signatures.split()
+    )
+
+def _prediction_from_webhook(payload: Dict[str, Any]) -> SimpleNamespace:
+    """Представление prediction из тела webhook с теми же атрибутами, что у объекта replicate"""
+    return SimpleNamespace(
+        id=payload.get('id'),
+        status=payload.get('status'),
+        output=payload.get('output'),
+        error=payload.get('error')
+    )
+
+def _to_jpeg(image_bytes: bytes) -> bytes:
+    """
+    Конвертация изображения в JPEG с уменьшением до MAX_UPLOAD_DIM (синхронно, выполняется через asyncio.to_thread);
+    подходящий JPEG возвращается как есть
+    
+    Args:
+        image_bytes: Исходные байты изображения
+        
+    Returns:
+        Байты JPEG
+        
+    Raises:
+        ValueError: Если байты не являются изображением
+    """
+    # Быстрый путь: корректный JPEG подходящего размера отправляется без перекодирования
+    if image_bytes[:3] == JPEG_SIGNATURE and len(image_bytes) < JPEG_PASSTHROUGH_MAX_BYTES:
+        try:
+            with Image.open(io.BytesIO(image_bytes)) as probe:
+                size, mode = probe.size, probe.mode
+                # verify() для JPEG ничего не проверяет: декодируем в уменьшенном масштабе (дешево),
+                # чтобы обрезанный или поврежденный файл не ушел в платный prediction
+                probe.draft('RGB', (256, 256))
+                probe.load()
+        except Exception as pil_err:
+            raise ValueError(f"Невозможно открыть изображение: {str(pil_err)}")
+        if max(size) <= MAX_UPLOAD_DIM and mode in ('RGB', 'L'):
+            return image_bytes
+    
+    try:
+        img = Image.open(io.BytesIO(image_bytes))
+    except Exception as pil_err:
+        raise ValueError(f"Невозможно открыть изображение: {str(pil_err)}")
+    
+    # Для JPEG декодер сразу масштабирует в DCT (1/2..1/8), не распаковывая полное разрешение
+    img.draft('RGB', (MAX_UPLOAD_DIM, MAX_UPLOAD_DIM))
+    # EXIF при перекодировании теряется, поэтому ориентация применяется к пикселям (как на быстром пути)
+    img = ImageOps.exif_transpose(img)
+    img = img.convert('RGB')
+    img.thumbnail((MAX_UPLOAD_DIM, MAX_UPLOAD_DIM), Image.LANCZOS)
+    
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=95, optimize=False, subsampling=2)
+    return buffer.getvalue()
+
+def _is_image(file_content: bytes) -> bool:
+    """Проверка сигнатуры изображения по первым 12 байтам (JPEG/PNG/GIF/WebP)"""
+    return file_content.startswith(IMAGE_SIGNATURES) or (
+        file_content[:4] == b'RIFF' and file_content[8:12] == b'WEBP'
+    )
+
+async def _iter_chunks(stream: IO[bytes]) -> AsyncIterator[bytes]:
+    """Чтение файлового объекта чанками по UPLOAD_CHUNK_SIZE в потоке, не блокируя event loop"""
+    while True:
+        chunk = await asyncio.to_thread(stream.read, UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+async def upload_image_to_replicate(image_source: Union[bytes, IO[bytes], AsyncIterable[bytes]], filename: str,
+                                    http_client: Optional[httpx.AsyncClient] = None,
+                                    size: Optional[int] = None) -> str:
+    """
+    Асинхронная потоковая загрузка изображения на Replicate и получение metadata URL
+    
+    Args:
+        image_source: Байты изображения, файловый объект или асинхронный поток чанков
         filename: Имя файла для загрузки
+        http_client: HTTP-клиент (по умолчанию общий клиент процесса)
+        size: Размер в байтах (для bytes и seekable-файлов определяется автоматически)
         
     Returns:
         Metadata URL (data['url'])
@@ -50,25 +247,103 @@ async def upload_image_to_replicate(image_bytes: bytes, filename: str) -> str:
             "Content-Type": "application/octet-stream",
             "X-File-Name": filename
         }
-        timeout = aiohttp.ClientTimeout(total=60)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.post(url, headers=headers, data=image_bytes) as response:
-                if response.status == 201:
-                    data = await response.json()
-                    if 'url' in data:
-                        metadata_url = data['url']
-                        logger.info(f"Изображение успешно загружено, metadata URL: {metadata_url}")
-                        return metadata_url
-                    else:
-                        raise Exception("Ответ не содержит URL")
-                else:
-                    error_text = await response.text()
-                    raise Exception(f"Ошибка загрузки на Replicate: HTTP {response.status} - {error_text}")
+        
+        # Байты передаются httpx как есть (Content-Length он выставит сам); файлы и потоки - чанками
+        if isinstance(image_source, (bytes, bytearray)):
+            body = bytes(image_source) if isinstance(image_source, bytearray) else image_source
+        else:
+            if hasattr(image_source, 'read'):
+                if size is None and image_source.seekable():
+                    position = image_source.tell()
+                    size = image_source.seek(0, io.SEEK_END) - position
+                    image_source.seek(position)
+                body = _iter_chunks(image_source)
+            else:
+                body = image_source
+            if size is not None:
+                headers["Content-Length"] = str(size)
+        
+        http_client = http_client or _get_http_client()
+        response = await http_client.post(url, headers=headers, content=body)
+        response.raise_for_status()
+        data = orjson.loads(response.content)
+        if 'url' not in data:
+            raise Exception("Ответ не содержит URL")
+        metadata_url = data['url']
+        logger.info(f"Изображение успешно загружено, metadata URL: {metadata_url}")
+        return metadata_url
     except Exception as e:
         logger.error(f"Ошибка при загрузке изображения на Replicate: {str(e)}")
         raise
 
-async def download_image(api_key: str, url: str, client: replicate.Client) -> bytes:
+async def upload_image_to_replicate_stream(path: str, filename: str,
+                                           http_client: Optional[httpx.AsyncClient] = None) -> str:
+    """
+    Потоковая загрузка файла с диска на Replicate без чтения целиком в память
+    
+    Args:
+        path: Путь к файлу изображения
+        filename: Имя файла для загрузки
+        http_client: HTTP-клиент (по умолчанию общий клиент процесса)
+        
+    Returns:
+        Metadata URL (data['url'])
+    """
+    async def file_chunks() -> AsyncIterator[bytes]:
+        async with aiofiles.open(path, 'rb') as f:
+            while True:
+                chunk = await f.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+    
+    return await upload_image_to_replicate(file_chunks(), filename, http_client=http_client, size=os.path.getsize(path))
+
+def _file_id_from_url(url: str) -> Optional[str]:
+    """Извлечение id файла из metadata URL без запроса к API (None, если формат не распознан)"""
+    file_id = url.split('?', 1)[0].rstrip('/').split('/')[-1]
+    return file_id if FILE_ID_RE.match(file_id) else None
+
+async def fetch_file_id(api_key: str, url: str,
+                        http_client: Optional[httpx.AsyncClient] = None) -> str:
+    """
+    Получение id файла из метаданных по metadata URL
+    
+    Args:
+        api_key: API ключ для Replicate
+        url: Metadata URL изображения (/v1/files/{id})
+        http_client: HTTP-клиент (по умолчанию общий клиент процесса)
+        
+    Returns:
+        id файла на Replicate
+        
+    Raises:
+        Exception: Если метаданные недоступны или не содержат id
+    """
+    headers = {
+        "Authorization": f"Token {api_key}",
+        "Accept": "application/json"
+    }
+    http_client = http_client or _get_http_client()
+    response = await http_client.get(url, headers=headers)
+    response.raise_for_status()
+    content_type = response.headers.get('Content-Type', '')
+    if not content_type.startswith('application/json'):
+        raise Exception(f"Ожидался JSON в метаданных, получен Content-Type: {content_type}")
+    
+    metadata = orjson.loads(response.content)
+    logger.debug(f"Метаданные изображения: {metadata}")
+    
+    if 'id' not in metadata:
+        raise Exception("Метаданные не содержат id файла")
+    
+    file_id = metadata['id']
+    logger.info(f"Извлечен file_id: {file_id}")
+    return file_id
+
+async def download_image(api_key: str, url: str, client: replicate.Client,
+                         http_client: Optional[httpx.AsyncClient] = None,
+                         file_id: Optional[str] = None) -> bytes:
     """
     Скачивание изображения по metadata URL с использованием replicate.Client
     
@@ -76,6 +351,8 @@ async def download_image(api_key: str, url: str, client: replicate.Client) -> by
         api_key: API ключ для Replicate
         url: Metadata URL изображения (/v1/files/{id})
         client: Экземпляр replicate.Client для прямого скачивания
+        http_client: HTTP-клиент (по умолчанию общий клиент процесса)
+        file_id: Уже известный id файла (пропускает запрос метаданных)
         
     Returns:
         Байты изображения
@@ -84,30 +361,11 @@ async def download_image(api_key: str, url: str, client: replicate.Client) -> by
         Exception: Если скачивание провалилось или данные не являются изображением
     """
     try:
-        # Шаг 1: Запрос метаданных для получения urls.get
-        headers = {
-            "Authorization": f"Token {api_key}",
-            "Accept": "application/json"
-        }
-        timeout = aiohttp.ClientTimeout(total=60)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.get(url, headers=headers) as response:
-                if response.status == 200:
-                    content_type = response.headers.get('Content-Type', '')
-                    if not content_type.startswith('application/json'):
-                        raise Exception(f"Ожидался JSON в метаданных, получен Content-Type: {content_type}")
-                    
-                    metadata = await response.json()
-                    logger.debug(f"Метаданные изображения: {metadata}")
-                    
-                    if 'id' not in metadata:
-                        raise Exception("Метаданные не содержат id файла")
-                    
-                    file_id = metadata['id']
-                    logger.info(f"Извлечен file_id: {file_id}")
-                else:
-                    error_text = await response.text()
-                    raise Exception(f"Ошибка получения метаданных: HTTP {response.status} - {error_text}")
+        # Шаг 1: id файла берется из URL; запрос метаданных только если формат не распознан
+        if file_id is None:
+            file_id = _file_id_from_url(url)
+        if file_id is None:
+            file_id = await fetch_file_id(api_key, url, http_client=http_client)
         
         # Шаг 2: Скачивание файла через replicate.Client
         logger.info(f"Попытка скачать файл с id {file_id} через replicate.Client")
@@ -120,10 +378,8 @@ async def download_image(api_key: str, url: str, client: replicate.Client) -> by
         logger.debug(f"Первые 10 байт скачанного изображения: {file_content[:10]}")
         
         # Проверка сигнатуры изображения
-        mime = magic.Magic(mime=True)
-        file_type = mime.from_buffer(file_content)
-        if not file_type.startswith('image/'):
-            raise Exception(f"Скачанные данные не являются изображением: MIME-тип {file_type}")
+        if not _is_image(file_content):
+            raise Exception(f"Скачанные данные не являются изображением: сигнатура {file_content[:12]!r}")
         
         return file_content
     
@@ -131,9 +387,256 @@ async def download_image(api_key: str, url: str, client: replicate.Client) -> by
         logger.error(f"Ошибка при скачивании изображения: {str(e)}")
         raise
 
+# Стили генерации с промптами для runwayml/gen4-image
+_STYLES: Mapping[str, Mapping[str, str]] = MappingProxyType({
+    "photoshop": MappingProxyType({
+        "name": "🤍 Фотошоп",
+        "description": "Улучшение качества без изменений",
+        "prompt_template": "Professional portrait photo of @person, enhanced quality, flawless high-definition smooth beautiful skin, perfect even skin tone, flawless complexion, razor-sharp focus on eyes, detailed ultra-realistic eyes, clean background, natural colors, perfect lighting, photorealistic, ultra-high resolution, 16K, masterpiece, best quality, hyper-detailed, no artifacts, sharp details everywhere, crystal-clear sharpness, flawless 32K resolution",
+        "model": "runwayml/gen4-image",
+        "model_type": "gen4",
+        "aspect_ratio": "3:4"
+    }),
+    "art": MappingProxyType({
+        "name": "🎨 AI Art",
+        "description": "Иллюстрация в авторском стиле",
+        "prompt_template": "Digital art illustration of @person, artistic style, flawless high-definition smooth beautiful skin, perfect even skin tone, flawless complexion, razor-sharp focus on eyes, detailed ultra-realistic eyes, pastel colors, creative portrait, Pinterest aesthetic, beautiful lighting, stylized, ultra-high resolution, 16K, masterpiece, best quality, hyper-detailed, no artifacts, sharp details everywhere, crystal-clear sharpness, flawless 32K resolution",
+        "model": "runwayml/gen4-image",
+        "model_type": "gen4",
+        "aspect_ratio": "3:4"
+    }),
+    "cinema": MappingProxyType({
+        "name": "🎬 Кино",
+        "description": "Кадр из художественного фильма",
+        "prompt_template": "Cinematic portrait of @person, movie scene, flawless high-definition smooth beautiful skin, perfect even skin tone, flawless complexion, razor-sharp focus on eyes, detailed ultra-realistic eyes, dramatic lighting, film grain, atmospheric colors, professional cinematography, ultra-high resolution, 16K, masterpiece, best quality, hyper-detailed, no artifacts, sharp details everywhere, crystal-clear sharpness, flawless 32K resolution",
+        "model": "runwayml/gen4-image",
+        "model_type": "gen4",
+        "aspect_ratio": "3:4"
+    }),
+    "portrait": MappingProxyType({
+        "name": "🧠 Портрет",
+        "description": "Глубокий психологический образ",
+        "prompt_template": "Deep psychological portrait of @person, soft shadows, face focus, flawless high-definition smooth beautiful skin, perfect even skin tone, flawless complexion, razor-sharp focus on eyes, detailed ultra-realistic eyes, character photography, soulful expression, professional photographer style, ultra-high resolution, 16K, masterpiece, best quality, hyper-detailed, no artifacts, sharp details everywhere, crystal-clear sharpness, flawless 32K resolution",
+        "model": "runwayml/gen4-image",
+        "model_type": "gen4",
+        "aspect_ratio": "3:4"
+    }),
+    "fantasy": MappingProxyType({
+        "name": "⚡ Фантастика",
+        "description": "Неон, sci-fi, визуальный драйв",
+        "prompt_template": "Cyberpunk portrait of @person, neon lights, sci-fi style, flawless high-definition smooth beautiful skin, perfect even skin tone, flawless complexion, razor-sharp focus on eyes, detailed ultra-realistic eyes, futuristic, glitch effects, dramatic lighting, cosmic atmosphere, ultra-high resolution, 16K, masterpiece, best quality, hyper-detailed, no artifacts, sharp details everywhere, crystal-clear sharpness, flawless 32K resolution",
+        "model": "runwayml/gen4-image",
+        "model_type": "gen4",
+        "aspect_ratio": "3:4"
+    }),
+    "lego": MappingProxyType({
+        "name": "🧱 LEGO",
+        "description": "Превращение в LEGO минифигурку",
+        "prompt_template": "A hyper-detailed LEGO minifigure of @person, ultra-realistic LEGO style, razor-sharp focus on eyes, detailed eyes, 4K resolution, vibrant colors, precise blocky textures, LEGO hair with stud details, glossy LEGO pieces, visible brick seams, LEGO cityscape background, cinematic lighting, plastic sheen, blocky toy-like nature, perfect LEGO brick alignment, stud patterns, reflective plastic surfaces, ultra-high resolution, 16K, masterpiece, best quality, no artifacts, sharp details everywhere, crystal-clear sharpness, flawless 32K resolution",
+        "model": "runwayml/gen4-image",
+        "model_type": "gen4",
+        "aspect_ratio": "3:4"
+    })
+})
+
+# Доступные соотношения сторон
+_ASPECT_RATIOS: Mapping[str, str] = MappingProxyType({
+    "9:16": "9:16",
+    "4:3": "4:3",
+    "3:4": "3:4",
+    "1:1": "1:1",
+    "16:9": "16:9"
+})
+
+# Маппинг для нормализации сокращенных aspect_ratio
+_ASPECT_RATIO_MAP: Mapping[str, str] = MappingProxyType({
+    "9": "9:16",
+    "16": "16:9",
+    "4": "4:3",
+    "3": "3:4",
+    "1": "1:1"
+})
+
+# Полные и сокращенные aspect_ratio -> нормализованное значение
+_ASPECT_RATIO_RESOLVE: Mapping[str, str] = MappingProxyType({**_ASPECT_RATIOS, **_ASPECT_RATIO_MAP})
+
+# Доступные разрешения (только 720p)
+_RESOLUTIONS: Mapping[str, str] = MappingProxyType({
+    "720p": "720p"
+})
+
+# Полные описания стилей для сообщений бота
+_STYLE_DESCRIPTIONS: Mapping[str, str] = MappingProxyType({
+    "photoshop": """🤍 Фотошоп / Улучшение
+
+Ты — как есть, но в идеальном свете.
+Фон вычищен, кожа выглядит свежо, цвета — естественные.
+Как будто твое фото ретушировал профи. Без лишних фильтров.
+
+📌 Подходит для: аватарки, резюме, профиля.
+⚡ PixelPie AI улучшит качество с помощью нейросети""",
+    "art": """🎨 AI Art / Иллюстрация
+
+Фото превращается в арт.
+Линии, свет, пастель или стиль digital-иллюстраций — и ты выглядишь как персонаж книги или Pinterest-постера.
+
+📌 Подходит для: творчества, сторис, эстетичного контента.
+🎨 PixelPie AI создаст уникальную иллюстрацию""",
+    "cinema": """🎬 Кино / Cinematic
+
+Ты в кадре — будто это сцена из фильма.
+Атмосферные цвета, направленный свет и немного драмы.
+
+📌 Подходит для: ярких образов, вау-эффекта, постов с настроением.
+🎥 PixelPie AI применит кинематографическую обработку""",
+    "portrait": """🧠 Портрет / Психологический
+
+Глубокий взгляд, мягкие тени, фокус на лице.
+Эффект, как будто ты снят фотографом, который умеет показать характер.
+
+📌 Подходит для: спокойных аватарок, презентаций, контента с душой.
+📸 PixelPie AI создаст профессиональный портрет""",
+    "fantasy": """⚡ Фантастика / Neon-Cyber
+
+Ты в другом времени, в другой вселенной.
+Глитчи, неон, драматичный свет — визуальный экшн прямо из sci-fi трейлера.
+
+📌 Подходит для: аватарок, сторис, ярких постов.
+🚀 PixelPie AI перенесет тебя в будущее""",
+    "lego": """🧱 LEGO / Минифигурка
+
+Превращение в детализированную LEGO минифигурку.
+Яркие цвета, блочные текстуры, культовый стиль конструктора.
+Каждая деталь проработана до мельчайших кубиков!
+
+📌 Подходит для: веселых аватарок, подарков, креативного контента.
+🧱 PixelPie AI создаст твою уникальную LEGO-версию"""
+})
+
+# Текст о выборе соотношения сторон
+_ASPECT_RATIO_DESCRIPTION = """
+📐 Выберите соотношение сторон для вашего изображения!
+
+Это как рамка для картины: определяет форму изображения.
+- 9:16: Вертикальный формат, идеален для сторис и мобильных экранов 📱
+- 16:9: Горизонтальный, как видео на YouTube или киноэкран 🎥
+- 1:1: Квадрат, классика для аватарок и постов в соцсетях 🔲
+- 3:4 / 4:3: Портретный или альбомный, универсальный для фото 📸
+
+PixelPie AI подстроит генерацию под выбранный формат для лучшего результата! ✨
+"""
+
+def _freeze_keyboard(keyboard: List[List[Dict[str, str]]]) -> Tuple[Tuple[Mapping[str, str], ...], ...]:
+    """Неизменяемая копия клавиатуры: общий экземпляр отдается всем вызывающим"""
+    return tuple(tuple(MappingProxyType(button) for button in row) for row in keyboard)
+
+class _AIMDLimiter:
+    """
+    Адаптивный лимит одновременных запросов к Replicate (AIMD):
+    +1 после AIMD_INCREASE_AFTER успехов подряд, деление пополам при 429/5xx
+    (один раз на эпизод перегрузки: запросы, начатые до снижения, лимит повторно не уменьшают)
+    """
+    
+    def __init__(self, initial_limit: int, max_limit: int):
+        self.limit = initial_limit
+        self.max_limit = max_limit
+        self._in_flight = 0
+        self._successes = 0
+        # Номер эпохи лимита: увеличивается при каждом снижении
+        self._epoch = 0
+        self._condition = asyncio.Condition()
+    
+    async def acquire(self) -> int:
+        """
+        Ожидание свободного слота в пределах текущего лимита
+        
+        Returns:
+            Эпоха лимита на момент получения слота (передается в release)
+        """
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+            return self._epoch
+    
+    async def release(self, epoch: int, succeeded: bool = False, overloaded: bool = False) -> None:
+        """
+        Освобождение слота и корректировка лимита; прочие исходы (failed/canceled, иные ошибки) нейтральны
+        
+        Args:
+            epoch: Эпоха, полученная из acquire
+            succeeded: Prediction завершился со статусом succeeded
+            overloaded: Replicate ответил 429/5xx
+        """
+        async with self._condition:
+            self._in_flight -= 1
+            if overloaded:
+                self._successes = 0
+                # Перегрузка уже учтена снижением после начала этого запроса
+                if epoch == self._epoch:
+                    self._epoch += 1
+                    self.limit = max(1, self.limit // 2)
+                    logger.warning(f"Replicate перегружен, лимит генераций снижен до {self.limit}")
+            elif succeeded:
+                self._successes += 1
+                if self._successes >= AIMD_INCREASE_AFTER and self.limit < self.max_limit:
+                    self._successes = 0
+                    self.limit += 1
+                    logger.info(f"Лимит одновременных генераций увеличен до {self.limit}")
+            self._condition.notify_all()
+
+def _is_overload_error(error: Exception) -> bool:
+    """Проверка, что ошибка Replicate означает перегрузку (HTTP 429 или 5xx)"""
+    status = getattr(error, 'status', None)
+    return isinstance(error, ReplicateError) and isinstance(status, int) and (status == 429 or status >= 500)
+
 class PhotoTransformGenerator:
     """Класс для генерации изображений по одному фото через Replicate"""
     
+    __slots__ = (
+        'api_key', 'client', 'styles', 'aspect_ratios', 'aspect_ratio_map', 'resolutions', '_ar_resolve',
+        '_has_async_api', '_limiter', '_pending', '_poll_schedule', '_poll_task',
+        '_file_id_cache', '_preprocessed_urls', '_style_keyboard', '_aspect_ratio_keyboards',
+        '_resolution_keyboards'
+    )
+    
+    # Ожидающие webhook prediction: prediction.id -> future ожидания
+    _webhook_waiters: Dict[str, asyncio.Future] = {}
+    # Webhook, пришедшие до начала ожидания: prediction.id -> (время получения, payload)
+    _early_webhooks: OrderedDict[str, Tuple[float, Dict[str, Any]]] = OrderedDict()
+    
+    @classmethod
+    def resolve_webhook(cls, payload: Dict[str, Any]) -> bool:
+        """
+        Обработка webhook от Replicate с уже проверенной подписью (вызывать в event loop бота)
+        
+        Args:
+            payload: JSON тело webhook (объект prediction)
+            
+        Returns:
+            True, если prediction уже ожидался корутиной генерации
+        """
+        prediction_id = payload.get('id')
+        if not prediction_id:
+            logger.warning("Webhook Replicate не содержит id prediction")
+            return False
+        
+        future = cls._webhook_waiters.get(prediction_id)
+        if future is not None:
+            if not future.done():
+                future.set_result(_prediction_from_webhook(payload))
+            return True
+        
+        # Webhook может прийти раньше, чем корутина начнет ждать: держим его недолго в малом кэше
+        now = time.monotonic()
+        cls._early_webhooks[prediction_id] = (now, payload)
+        cls._early_webhooks.move_to_end(prediction_id)
+        while cls._early_webhooks:
+            oldest_time, _ = next(iter(cls._early_webhooks.values()))
+            if len(cls._early_webhooks) <= EARLY_WEBHOOK_CACHE_SIZE and now - oldest_time < EARLY_WEBHOOK_TTL:
+                break
+            cls._early_webhooks.popitem(last=False)
+        return False
+    
     def __init__(self, replicate_api_key: str):
         """
         Инициализация генератора
@@ -144,90 +647,152 @@ class PhotoTransformGenerator:
         self.api_key = replicate_api_key
         os.environ["REPLICATE_API_TOKEN"] = replicate_api_key
         
-        # Стили генерации с промптами для runwayml/gen4-image
-        self.styles = {
-            "photoshop": {
-                "name": "🤍 Фотошоп",
-                "description": "Улучшение качества без изменений",
-                "prompt_template": "Professional portrait photo of @person, enhanced quality, flawless high-definition smooth beautiful skin, perfect even skin tone, flawless complexion, razor-sharp focus on eyes, detailed ultra-realistic eyes, clean background, natural colors, perfect lighting, photorealistic, ultra-high resolution, 16K, masterpiece, best quality, hyper-detailed, no artifacts, sharp details everywhere, crystal-clear sharpness, flawless 32K resolution",
-                "model": "runwayml/gen4-image",
-                "model_type": "gen4",
-                "aspect_ratio": "3:4"
-            },
-            "art": {
-                "name": "🎨 AI Art",
-                "description": "Иллюстрация в авторском стиле",
-                "prompt_template": "Digital art illustration of @person, artistic style, flawless high-definition smooth beautiful skin, perfect even skin tone, flawless complexion, razor-sharp focus on eyes, detailed ultra-realistic eyes, pastel colors, creative portrait, Pinterest aesthetic, beautiful lighting, stylized, ultra-high resolution, 16K, masterpiece, best quality, hyper-detailed, no artifacts, sharp details everywhere, crystal-clear sharpness, flawless 32K resolution",
-                "model": "runwayml/gen4-image",
-                "model_type": "gen4",
-                "aspect_ratio": "3:4"
-            },
-            "cinema": {
-                "name": "🎬 Кино",
-                "description": "Кадр из художественного фильма",
-                "prompt_template": "Cinematic portrait of @person, movie scene, flawless high-definition smooth beautiful skin, perfect even skin tone, flawless complexion, razor-sharp focus on eyes, detailed ultra-realistic eyes, dramatic lighting, film grain, atmospheric colors, professional cinematography, ultra-high resolution, 16K, masterpiece, best quality, hyper-detailed, no artifacts, sharp details everywhere, crystal-clear sharpness, flawless 32K resolution",
-                "model": "runwayml/gen4-image",
-                "model_type": "gen4",
-                "aspect_ratio": "3:4"
-            },
-            "portrait": {
-                "name": "🧠 Портрет",
-                "description": "Глубокий психологический образ",
-                "prompt_template": "Deep psychological portrait of @person, soft shadows, face focus, flawless high-definition smooth beautiful skin, perfect even skin tone, flawless complexion, razor-sharp focus on eyes, detailed ultra-realistic eyes, character photography, soulful expression, professional photographer style, ultra-high resolution, 16K, masterpiece, best quality, hyper-detailed, no artifacts, sharp details everywhere, crystal-clear sharpness, flawless 32K resolution",
-                "model": "runwayml/gen4-image",
-                "model_type": "gen4",
-                "aspect_ratio": "3:4"
-            },
-            "fantasy": {
-                "name": "⚡ Фантастика",
-                "description": "Неон, sci-fi, визуальный драйв",
-                "prompt_template": "Cyberpunk portrait of @person, neon lights, sci-fi style, flawless high-definition smooth beautiful skin, perfect even skin tone, flawless complexion, razor-sharp focus on eyes, detailed ultra-realistic eyes, futuristic, glitch effects, dramatic lighting, cosmic atmosphere, ultra-high resolution, 16K, masterpiece, best quality, hyper-detailed, no artifacts, sharp details everywhere, crystal-clear sharpness, flawless 32K resolution",
-                "model": "runwayml/gen4-image",
-                "model_type": "gen4",
-                "aspect_ratio": "3:4"
-            },
-            "lego": {
-                "name": "🧱 LEGO",
-                "description": "Превращение в LEGO минифигурку",
-                "prompt_template": "A hyper-detailed LEGO minifigure of @person, ultra-realistic LEGO style, razor-sharp focus on eyes, detailed eyes, 4K resolution, vibrant colors, precise blocky textures, LEGO hair with stud details, glossy LEGO pieces, visible brick seams, LEGO cityscape background, cinematic lighting, plastic sheen, blocky toy-like nature, perfect LEGO brick alignment, stud patterns, reflective plastic surfaces, ultra-high resolution, 16K, masterpiece, best quality, no artifacts, sharp details everywhere, crystal-clear sharpness, flawless 32K resolution",
-                "model": "runwayml/gen4-image",
-                "model_type": "gen4",
-                "aspect_ratio": "3:4"
-            }
-        }
+        # Справочники стилей и форматов общие для всех экземпляров (неизменяемые)
+        self.styles = _STYLES
+        self.aspect_ratios = _ASPECT_RATIOS
+        self.aspect_ratio_map = _ASPECT_RATIO_MAP
+        self.resolutions = _RESOLUTIONS
+        self._ar_resolve = _ASPECT_RATIO_RESOLVE
         
-        # Доступные соотношения сторон
-        self.aspect_ratios = {
-            "9:16": "9:16",
-            "4:3": "4:3",
-            "3:4": "3:4",
-            "1:1": "1:1",
-            "16:9": "16:9"
-        }
+        # Клиент Replicate: files.get и predictions.* идут через его собственный httpx-клиент
+        try:
+            self.client = replicate.Client(api_token=replicate_api_key, http2=HTTP2_AVAILABLE)
+        except TypeError:
+            # Старые версии replicate не передают параметры в httpx
+            self.client = replicate.Client(api_token=replicate_api_key)
+        # Нативный async API (replicate>=0.22); в старых версиях - sync через поток
+        self._has_async_api = hasattr(self.client.predictions, 'async_create')
+        self._limiter = _AIMDLimiter(AIMD_INITIAL_LIMIT, AIMD_MAX_LIMIT)
         
-        # Маппинг для нормализации сокращенных aspect_ratio
-        self.aspect_ratio_map = {
-            "9": "9:16",
-            "16": "16:9",
-            "4": "4:3",
-            "3": "3:4",
-            "1": "1:1"
-        }
+        # Пакетный опрос prediction: prediction.id -> future и (задержка, время следующей проверки)
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._poll_schedule: Dict[str, Tuple[float, float]] = {}
+        self._poll_task: Optional[asyncio.Task] = None
+        
+        # LRU кэш file_id по metadata URL (байты не кэшируются: нормализованный URL повторно не скачивается)
+        self._file_id_cache: OrderedDict[str, str] = OrderedDict()
+        
+        # URL, которые уже прошли нормализацию в JPG (preprocess_and_upload)
+        self._preprocessed_urls: OrderedDict[str, None] = OrderedDict()
         
-        # Доступные разрешения (только 720p)
-        self.resolutions = {
-            "720p": "720p"
+        # Клавиатуры строятся один раз: набор стилей и форматов фиксирован
+        self._style_keyboard = self._build_style_keyboard()
+        self._aspect_ratio_keyboards = {
+            style_key: self._build_aspect_ratio_keyboard(style_key)
+            for style_key in self.styles
         }
+        self._resolution_keyboards = {
+            (style_key, ratio_key): self._build_resolution_keyboard(style_key, ratio_key)
+            for style_key in self.styles
+            for ratio_key in self.aspect_ratios
+        }
+    
+    @property
+    def _http(self) -> httpx.AsyncClient:
+        """Общий HTTP-клиент процесса (создается лениво)"""
+        return _get_http_client()
+    
+    async def close(self) -> None:
+        """Остановка фонового опроса и закрытие общего HTTP-клиента при остановке бота"""
+        poll_task = self._poll_task
+        if poll_task is not None:
+            poll_task.cancel()
+            await asyncio.gather(poll_task, return_exceptions=True)
+        await close_http_client()
+    
+    async def upload_image(self, image_bytes: bytes, filename: str) -> str:
+        """
+        Загрузка изображения на Replicate через общий HTTP-клиент
+        
+        Args:
+            image_bytes: Байты изображения
+            filename: Имя файла для загрузки
+            
+        Returns:
+            Metadata URL (data['url'])
+        """
+        return await upload_image_to_replicate(image_bytes, filename, http_client=self._http)
+    
+    async def preprocess_and_upload(self, image_bytes: bytes, filename: str = "processed.jpg") -> str:
+        """
+        Нормализация фото пользователя в JPG и единственная загрузка на Replicate
+        
+        Args:
+            image_bytes: Исходные байты фото
+            filename: Имя файла для загрузки
+            
+        Returns:
+            Metadata URL загруженного JPG
+            
+        Raises:
+            ValueError: Если байты не являются изображением
+        """
+        # Декодирование/кодирование JPEG в потоке, чтобы не блокировать event loop
+        processed_image_bytes = await asyncio.to_thread(_to_jpeg, image_bytes)
+        metadata_url = await self.upload_image(processed_image_bytes, filename)
+        self._remember_preprocessed(metadata_url)
+        return metadata_url
+    
+    async def _ensure_preprocessed(self, image_url: str) -> str:
+        """
+        Нормализация изображения, загруженного в обход preprocess_and_upload
+        
+        Args:
+            image_url: Metadata URL исходного изображения
+            
+        Returns:
+            Metadata URL изображения, пригодного для модели
+        """
+        if image_url in self._preprocessed_urls:
+            self._preprocessed_urls.move_to_end(image_url)
+            return image_url
+        
+        logger.info(f"Изображение {image_url} загружено без нормализации, обрабатываем перед генерацией")
+        image_bytes = await self.download_image(image_url)
+        processed_image_bytes = await asyncio.to_thread(_to_jpeg, image_bytes)
+        if processed_image_bytes is not image_bytes:
+            image_url = await self.upload_image(processed_image_bytes, "processed.jpg")
+        self._remember_preprocessed(image_url)
+        return image_url
+    
+    def _remember_preprocessed(self, image_url: str) -> None:
+        """Запоминание URL нормализованного изображения с вытеснением самых старых"""
+        self._preprocessed_urls[image_url] = None
+        self._preprocessed_urls.move_to_end(image_url)
+        while len(self._preprocessed_urls) > PREPROCESSED_URLS_SIZE:
+            self._preprocessed_urls.popitem(last=False)
+    
+    async def download_image(self, url: str) -> bytes:
+        """
+        Скачивание изображения по metadata URL через общий HTTP-клиент; используется _ensure_preprocessed
+        для изображений, загруженных в обход preprocess_and_upload
+        
+        Args:
+            url: Metadata URL изображения (/v1/files/{id})
+            
+        Returns:
+            Байты изображения
+        """
+        http_client = self._http
+        file_id = self._file_id_cache.get(url)
+        if file_id is not None:
+            self._file_id_cache.move_to_end(url)
+        else:
+            file_id = _file_id_from_url(url)
+        if file_id is None:
+            file_id = await fetch_file_id(self.api_key, url, http_client=http_client)
+            self._file_id_cache[url] = file_id
+            if len(self._file_id_cache) > FILE_ID_CACHE_SIZE:
+                self._file_id_cache.popitem(last=False)
         
-        # Клиент Replicate
-        self.client = replicate.Client(api_token=replicate_api_key)
+        return await download_image(self.api_key, url, self.client, http_client=http_client, file_id=file_id)
     
     async def generate_image(self, image_url: str, style: str, user_id: int, aspect_ratio: str = "3:4", resolution: str = "720p") -> Dict[str, Any]:
         """
         Генерация изображения в выбранном стиле с поддержкой aspect_ratio (resolution фиксировано 720p)
         
         Args:
-            image_url: metadata URL изображения (/v1/files/{id})
+            image_url: metadata URL изображения (/v1/files/{id}); лучше загружать через preprocess_and_upload
             style: Выбранный стиль генерации
             user_id: ID пользователя
             aspect_ratio: Соотношение сторон
@@ -242,65 +807,56 @@ class PhotoTransformGenerator:
             if style not in self.styles:
                 raise ValueError(f"Неизвестный стиль: {style}")
             
-            # Нормализация aspect_ratio если передан сокращенный вариант
-            if aspect_ratio in self.aspect_ratio_map:
-                aspect_ratio = self.aspect_ratio_map[aspect_ratio]
-                logger.info(f"Нормализовали aspect_ratio к {aspect_ratio}")
-            
-            if aspect_ratio not in self.aspect_ratios:
+            # Нормализация aspect_ratio (в т.ч. сокращенного варианта) одним поиском
+            normalized_ratio = self._ar_resolve.get(aspect_ratio)
+            if normalized_ratio is None:
                 raise ValueError(f"Неподдерживаемое соотношение сторон: {aspect_ratio}")
+            aspect_ratio = normalized_ratio
             
             if resolution not in self.resolutions:
                 raise ValueError(f"Неподдерживаемое разрешение: {resolution}")
             
             style_config = self.styles[style]
             
-            # Предобработка изображения: скачивание и конвертация в JPG
-            logger.info(f"Предобработка изображения: скачивание и конвертация в JPG")
-            image_bytes = await download_image(self.api_key, image_url, self.client)
+            # Изображения из preprocess_and_upload уже нормализованы; остальные обрабатываются здесь
+            image_url = await self._ensure_preprocessed(image_url)
             
-            # Валидация через PIL
-            try:
-                img = Image.open(io.BytesIO(image_bytes))
-            except Exception as pil_err:
-                raise ValueError(f"Невозможно открыть изображение: {str(pil_err)}")
-            
-            buffer = io.BytesIO()
-            img.convert('RGB').save(buffer, format="JPEG", quality=95)
-            buffer.seek(0)
-            processed_image_bytes = buffer.read()
-            
-            # Перезагружаем обработанное изображение на Replicate
-            processed_url = await upload_image_to_replicate(processed_image_bytes, "processed.jpg")
-            
-            # Параметры для модели runwayml/gen4-image
             input_params = {
                 "prompt": style_config['prompt_template'],
                 "aspect_ratio": aspect_ratio,
                 "reference_tags": ["person"],
-                "reference_images": [processed_url],
+                "reference_images": [image_url],
                 "output_resolution": resolution
             }
             
             # Создаем prediction через API
             logger.info(f"Создание prediction для модели {style_config['model']}")
             
-            prediction = await asyncio.to_thread(
-                self.client.predictions.create,
-                model=style_config['model'],
-                input=input_params
-            )
-            
-            logger.info(f"Prediction создан: {prediction.id}")
+            create_kwargs = {
+                "model": style_config['model'],
+                "input": input_params
+            }
+            if WEBHOOK_ENABLED:
+                create_kwargs["webhook"] = REPLICATE_WEBHOOK_URL
+                create_kwargs["webhook_events_filter"] = ["completed"]
             
-            # Ждем завершения
-            while prediction.status not in ["succeeded", "failed", "canceled"]:
-                await asyncio.sleep(2)
-                prediction = await asyncio.to_thread(
-                    self.client.predictions.get,
-                    prediction.id
-                )
-                logger.info(f"Статус: {prediction.status}")
+            # Создание и ожидание под адаптивным лимитом одновременных генераций
+            epoch = await self._limiter.acquire()
+            succeeded = False
+            overloaded = False
+            try:
+                prediction = await self._create_prediction(**create_kwargs)
+                
+                logger.info(f"Prediction создан: {prediction.id}")
+                
+                # Ждем завершения
+                prediction = await self._wait_for_prediction(prediction)
+                succeeded = prediction.status == "succeeded"
+            except ReplicateError as replicate_err:
+                overloaded = _is_overload_error(replicate_err)
+                raise
+            finally:
+                await self._limiter.release(epoch, succeeded=succeeded, overloaded=overloaded)
             
             if prediction.status == "succeeded":
                 output_url = prediction.output
@@ -346,13 +902,119 @@ class PhotoTransformGenerator:
                 "timestamp": datetime.now().isoformat()
             }
     
-    def get_style_keyboard(self) -> List[List[Dict[str, str]]]:
+    async def _create_prediction(self, **kwargs) -> Any:
+        """Создание prediction через async API Replicate (или sync-клиент в потоке)"""
+        if self._has_async_api:
+            return await self.client.predictions.async_create(**kwargs)
+        return await asyncio.to_thread(self.client.predictions.create, **kwargs)
+    
+    async def _get_prediction(self, prediction_id: str) -> Any:
+        """Получение prediction через async API Replicate (или sync-клиент в потоке)"""
+        if self._has_async_api:
+            return await self.client.predictions.async_get(prediction_id)
+        return await asyncio.to_thread(self.client.predictions.get, prediction_id)
+    
+    async def _wait_for_prediction(self, prediction: Any) -> Any:
+        """
+        Ожидание завершения prediction: через webhook (если настроен) с редким страховочным опросом,
+        иначе опросом с экспоненциальной задержкой
+        
+        Args:
+            prediction: Созданный prediction
+            
+        Returns:
+            Prediction (или его webhook-представление) в терминальном статусе
+        """
+        if prediction.status in TERMINAL_STATUSES:
+            return prediction
+        
+        if WEBHOOK_ENABLED:
+            early = self._early_webhooks.pop(prediction.id, None)
+            if early is not None:
+                logger.info(f"Статус из webhook: {early[1].get('status')}")
+                return _prediction_from_webhook(early[1])
+        
+        # Опрос выполняет общая фоновая задача для всех ожидающих prediction; webhook завершает тот же future
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        initial_delay = WEBHOOK_POLL_INTERVAL if WEBHOOK_ENABLED else POLL_INITIAL_DELAY
+        self._pending[prediction.id] = future
+        self._poll_schedule[prediction.id] = (initial_delay, loop.time() + initial_delay)
+        if WEBHOOK_ENABLED:
+            self._webhook_waiters[prediction.id] = future
+        if self._poll_task is None:
+            self._poll_task = asyncio.create_task(self._poll_loop())
+        try:
+            return await future
+        finally:
+            self._pending.pop(prediction.id, None)
+            self._poll_schedule.pop(prediction.id, None)
+            self._webhook_waiters.pop(prediction.id, None)
+    
+    async def _poll_loop(self) -> None:
+        """
+        Фоновый пакетный опрос: просыпается к ближайшему времени проверки (не реже BATCH_POLL_INTERVAL),
+        одним пакетом запрашивает статусы всех prediction, у которых оно подошло, и завершает future
+        для терминальных статусов
+        """
+        loop = asyncio.get_running_loop()
+        error: Exception = RuntimeError("Опрос статуса prediction остановлен")
+        try:
+            while self._pending:
+                now = loop.time()
+                next_check = min((check for _, check in self._poll_schedule.values()), default=now)
+                await asyncio.sleep(min(max(0.0, next_check - now), BATCH_POLL_INTERVAL))
+                now = loop.time()
+                due = [
+                    prediction_id for prediction_id, (_, next_check) in self._poll_schedule.items()
+                    if next_check <= now
+                ]
+                if not due:
+                    continue
+                
+                results = await asyncio.gather(
+                    *(self._get_prediction(prediction_id) for prediction_id in due),
+                    return_exceptions=True
+                )
+                for prediction_id, result in zip(due, results):
+                    future = self._pending.get(prediction_id)
+                    if future is None or future.done():
+                        continue
+                    # gather может вернуть CancelledError, который не наследует Exception;
+                    # ожидающему он передается обычной ошибкой, чтобы не выглядеть отменой его задачи
+                    if isinstance(result, asyncio.CancelledError):
+                        future.set_exception(RuntimeError(f"Запрос статуса {prediction_id} отменен"))
+                    elif isinstance(result, BaseException):
+                        future.set_exception(result)
+                    elif result.status in TERMINAL_STATUSES:
+                        future.set_result(result)
+                    else:
+                        logger.info(f"Статус {prediction_id}: {result.status}")
+                        # Задержка растет до POLL_MAX_DELAY; большая стартовая (режим webhook) не уменьшается
+                        delay = self._poll_schedule[prediction_id][0]
+                        delay = min(delay * POLL_BACKOFF_FACTOR, max(POLL_MAX_DELAY, delay))
+                        self._poll_schedule[prediction_id] = (delay, loop.time() + delay)
+        except Exception as e:
+            logger.error(f"Сбой фонового опроса prediction: {e}", exc_info=True)
+            error = e
+        finally:
+            self._poll_task = None
+            # При остановке или сбое опроса ожидающие генерации не должны зависнуть
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(error)
+    
+    def get_style_keyboard(self) -> Tuple[Tuple[Mapping[str, str], ...], ...]:
         """
-        Получение клавиатуры со стилями для inline-кнопок
+        Получение клавиатуры со стилями для inline-кнопок (общий экземпляр, только для чтения)
         
         Returns:
             Список кнопок для InlineKeyboardMarkup
         """
+        return self._style_keyboard
+    
+    def _build_style_keyboard(self) -> Tuple[Tuple[Mapping[str, str], ...], ...]:
+        """Построение клавиатуры со стилями"""
         keyboard = []
         row = []
         for style_key, style_info in self.styles.items():
@@ -369,11 +1031,11 @@ class PhotoTransformGenerator:
             keyboard.append(row)
         
         keyboard.append([{"text": "❌ Отменить", "callback_data": "transform_cancel"}])
-        return keyboard
+        return _freeze_keyboard(keyboard)
     
-    def get_style_info(self, style: str) -> Optional[Dict[str, str]]:
+    def get_style_info(self, style: str) -> Optional[Mapping[str, str]]:
         """
-        Получение информации о стиле
+        Получение информации о стиле (только для чтения)
         
         Args:
             style: Ключ стиля
@@ -393,57 +1055,11 @@ class PhotoTransformGenerator:
         Returns:
             Текстовое описание стиля
         """
-        descriptions = {
-            "photoshop": """🤍 Фотошоп / Улучшение
-
-Ты — как есть, но в идеальном свете.
-Фон вычищен, кожа выглядит свежо, цвета — естественные.
-Как будто твое фото ретушировал профи. Без лишних фильтров.
-
-📌 Подходит для: аватарки, резюме, профиля.
-⚡ PixelPie AI улучшит качество с помощью нейросети""",
-            "art": """🎨 AI Art / Иллюстрация
-
-Фото превращается в арт.
-Линии, свет, пастель или стиль digital-иллюстраций — и ты выглядишь как персонаж книги или Pinterest-постера.
-
-📌 Подходит для: творчества, сторис, эстетичного контента.
-🎨 PixelPie AI создаст уникальную иллюстрацию""",
-            "cinema": """🎬 Кино / Cinematic
-
-Ты в кадре — будто это сцена из фильма.
-Атмосферные цвета, направленный свет и немного драмы.
-
-📌 Подходит для: ярких образов, вау-эффекта, постов с настроением.
-🎥 PixelPie AI применит кинематографическую обработку""",
-            "portrait": """🧠 Портрет / Психологический
-
-Глубокий взгляд, мягкие тени, фокус на лице.
-Эффект, как будто ты снят фотографом, который умеет показать характер.
-
-📌 Подходит для: спокойных аватарок, презентаций, контента с душой.
-📸 PixelPie AI создаст профессиональный портрет""",
-            "fantasy": """⚡ Фантастика / Neon-Cyber
-
-Ты в другом времени, в другой вселенной.
-Глитчи, неон, драматичный свет — визуальный экшн прямо из sci-fi трейлера.
-
-📌 Подходит для: аватарок, сторис, ярких постов.
-🚀 PixelPie AI перенесет тебя в будущее""",
-            "lego": """🧱 LEGO / Минифигурка
-
-Превращение в детализированную LEGO минифигурку.
-Яркие цвета, блочные текстуры, культовый стиль конструктора.
-Каждая деталь проработана до мельчайших кубиков!
-
-📌 Подходит для: веселых аватарок, подарков, креативного контента.
-🧱 PixelPie AI создаст твою уникальную LEGO-версию"""
-        }
-        return descriptions.get(style, "Описание недоступно")
+        return _STYLE_DESCRIPTIONS.get(style, "Описание недоступно")
     
-    def get_aspect_ratio_keyboard(self, style_key: str) -> List[List[Dict[str, str]]]:
+    def get_aspect_ratio_keyboard(self, style_key: str) -> Tuple[Tuple[Mapping[str, str], ...], ...]:
         """
-        Получение клавиатуры для выбора соотношения сторон
+        Получение клавиатуры для выбора соотношения сторон (общий экземпляр, только для чтения)
         
         Args:
             style_key: Ключ стиля для callback_data
@@ -451,6 +1067,13 @@ class PhotoTransformGenerator:
         Returns:
             Список кнопок для InlineKeyboardMarkup
         """
+        keyboard = self._aspect_ratio_keyboards.get(style_key)
+        if keyboard is None:
+            keyboard = self._build_aspect_ratio_keyboard(style_key)
+        return keyboard
+    
+    def _build_aspect_ratio_keyboard(self, style_key: str) -> Tuple[Tuple[Mapping[str, str], ...], ...]:
+        """Построение клавиатуры выбора соотношения сторон для стиля"""
         keyboard = []
         row = []
         for ratio_key in self.aspect_ratios:
@@ -467,11 +1090,11 @@ class PhotoTransformGenerator:
             keyboard.append(row)
         
         keyboard.append([{"text": "❌ Отменить", "callback_data": "transform_cancel"}])
-        return keyboard
+        return _freeze_keyboard(keyboard)
     
-    def get_resolution_keyboard(self, style_key: str, aspect_ratio: str) -> List[List[Dict[str, str]]]:
+    def get_resolution_keyboard(self, style_key: str, aspect_ratio: str) -> Tuple[Tuple[Mapping[str, str], ...], ...]:
         """
-        Получение клавиатуры для выбора разрешения (только 720p)
+        Получение клавиатуры для выбора разрешения (только 720p; общий экземпляр, только для чтения)
         
         Args:
             style_key: Ключ стиля
@@ -480,6 +1103,13 @@ class PhotoTransformGenerator:
         Returns:
             Список кнопок для InlineKeyboardMarkup
         """
+        keyboard = self._resolution_keyboards.get((style_key, aspect_ratio))
+        if keyboard is None:
+            keyboard = self._build_resolution_keyboard(style_key, aspect_ratio)
+        return keyboard
+    
+    def _build_resolution_keyboard(self, style_key: str, aspect_ratio: str) -> Tuple[Tuple[Mapping[str, str], ...], ...]:
+        """Построение клавиатуры выбора разрешения для стиля и соотношения сторон"""
         keyboard = []
         row = []
         for res_key in self.resolutions:
@@ -493,7 +1123,7 @@ class PhotoTransformGenerator:
             keyboard.append(row)
         
         keyboard.append([{"text": "❌ Отменить", "callback_data": "transform_cancel"}])
-        return keyboard
+        return _freeze_keyboard(keyboard)
     
     def get_aspect_ratio_description(self) -> str:
         """
@@ -502,14 +1132,4 @@ class PhotoTransformGenerator:
         Returns:
             Текст для показа в сообщении бота
         """
-        return """
-📐 Выберите соотношение сторон для вашего изображения!
-
-Это как рамка для картины: определяет форму изображения.
-- 9:16: Вертикальный формат, идеален для сторис и мобильных экранов 📱
-- 16:9: Горизонтальный, как видео на YouTube или киноэкран 🎥
-- 1:1: Квадрат, классика для аватарок и постов в соцсетях 🔲
-- 3:4 / 4:3: Портретный или альбомный, универсальный для фото 📸
-
-PixelPie AI подстроит генерацию под выбранный формат для лучшего результата! ✨
-"""
\ No newline at end of file
+        return _ASPECT_RATIO_DESCRIPTION
\ No newline at end of file